@@ -1 +1,4 @@
 from .state_machine import StateMachine
+from .storage import migrate_database
+from .worker import StateMachineWorker
+from .cache import ActivityCache, ACTIVITY_CACHE
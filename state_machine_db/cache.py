@@ -0,0 +1,133 @@
+'''
+    This module implements a process-wide, size-bounded LRU cache of the
+    activity records stored in the STATE_MACHINE table
+
+'''
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class ActivityCache(object):
+    '''
+
+    LRU cache of activity records, keyed by the real path of their database
+    and activity_id, so every path to the same database shares its records.
+    State machines whose activity_cache is set update it whenever they save
+    a state (write-through) and read it before restoring from the database.
+    Records written by other processes are not seen, so multi-process setups
+    must invalidate the records of the activities they take over;
+    invalidation hooks are notified of every invalidation, so they can be
+    propagated
+
+    Arguments:
+        max_size (:obj:`int`, optional): maximum number of cached records
+
+        '''
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._invalidation_hooks = []
+
+    def get(self, sm_database_path, activity_id):
+        '''
+        Gets the cached record of an activity, marking it as recently used
+
+        Arguments:
+            sm_database_path (:obj:`str`): path to the sqlite database
+            activity_id (:obj:`str`): identifier of the activity
+
+        Returns:
+            A dictionary with the record's fields, or None if it is not cached
+
+        '''
+        key = (os.path.realpath(sm_database_path), activity_id)
+        with self._lock:
+            record = self._records.pop(key, None)
+            if record is None:
+                self.misses += 1
+                return None
+            self._records[key] = record
+            self.hits += 1
+        return dict(record)
+
+    def put(self, sm_database_path, activity_id, record):
+        '''
+        Caches the record of an activity, evicting the least recently used
+        records if the cache is full
+
+        Arguments:
+            sm_database_path (:obj:`str`): path to the sqlite database
+            activity_id (:obj:`str`): identifier of the activity
+            record (:obj:`dict`): fields of the activity
+
+        '''
+        key = (os.path.realpath(sm_database_path), activity_id)
+        with self._lock:
+            self._records.pop(key, None)
+            self._records[key] = dict(record)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def invalidate(self, sm_database_path, activity_id=None):
+        '''
+        Discards the cached record of an activity, or of every activity of
+        a database if activity_id is None, and notifies the invalidation hooks
+
+        Arguments:
+            sm_database_path (:obj:`str`): path to the sqlite database
+            activity_id (:obj:`str`, optional): identifier of the activity
+
+        '''
+        sm_database_path = os.path.realpath(sm_database_path)
+        with self._lock:
+            if activity_id is None:
+                for key in [key for key in self._records if key[0] == sm_database_path]:
+                    del self._records[key]
+            else:
+                self._records.pop((sm_database_path, activity_id), None)
+            hooks = list(self._invalidation_hooks)
+        for hook in hooks:
+            hook(sm_database_path, activity_id)
+
+    def clear(self):
+        '''
+        Discards every cached record
+
+        '''
+        with self._lock:
+            self._records.clear()
+
+    def add_invalidation_hook(self, hook):
+        '''
+        Registers a callable to be notified of every invalidation
+
+        Arguments:
+            hook (:obj:`callable`): called with the real path of the database
+                and activity_id (None when a whole database was invalidated)
+
+        '''
+        with self._lock:
+            self._invalidation_hooks.append(hook)
+
+    def remove_invalidation_hook(self, hook):
+        '''
+        Unregisters a callable added by add_invalidation_hook
+
+        Arguments:
+            hook (:obj:`callable`): the callable to be removed
+
+        '''
+        with self._lock:
+            self._invalidation_hooks.remove(hook)
+
+    def __len__(self):
+        return len(self._records)
+
+
+# Cache shared by the state machines of this process that opt in to it
+ACTIVITY_CACHE = ActivityCache()
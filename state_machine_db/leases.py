@@ -0,0 +1,176 @@
+'''
+    This module implements lease based ownership of activities, so several
+    worker processes can share the same state machine database
+
+'''
+
+import sqlite3 as sql
+import os
+import socket
+from time import time
+from uuid import uuid4
+
+
+def default_owner():
+    '''
+    Builds an owner identifier that is unique among the workers of a host
+
+    Returns:
+        A string made of the host name, the process id and a random suffix
+
+    '''
+    return socket.gethostname()+':'+str(os.getpid())+':'+uuid4().hex[:8]
+
+
+def _now(now):
+    '''
+    Returns now, or the current epoch timestamp if now is None
+
+    '''
+    return int(time()) if now is None else now
+
+
+def _connect(sm_database_path):
+    '''
+    Opens a connection whose transactions are handled explicitly
+
+    '''
+    con = sql.connect(sm_database_path)
+    con.isolation_level = None
+    return con
+
+
+def claim_activities(sm_database_path, owner, batch_size, lease_duration, now=None):
+    '''
+    Atomically takes the lease of a batch of unfinished activities that are
+    either unowned or whose lease has expired
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        owner (:obj:`str`): identifier of the claiming worker
+        batch_size (:obj:`int`): maximum number of activities to claim
+        lease_duration (:obj:`int`): lease duration, in seconds
+        now (:obj:`int`, optional): current epoch timestamp
+
+    Returns:
+        A list with the ids of the claimed activities
+
+    '''
+    now = _now(now)
+    con = _connect(sm_database_path)
+    try:
+        cur = con.cursor()
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers
+        # can never select the same activities
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.execute('SELECT activity_id FROM STATE_MACHINE WHERE is_finished = 0 '\
+                +'AND (lease_owner IS NULL OR lease_expires < ?) '\
+                +'ORDER BY activity_creation_date LIMIT ?', (now, batch_size))
+            activity_ids = [row[0] for row in cur.fetchall()]
+            cur.executemany('UPDATE STATE_MACHINE SET lease_owner = ?, lease_expires = ?, '\
+                +'lease_heartbeat = ? WHERE activity_id = ?',
+                            [(owner, now+lease_duration, now, activity_id)
+                             for activity_id in activity_ids])
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+    finally:
+        con.close()
+    return activity_ids
+
+
+def claim_activity(sm_database_path, activity_id, owner, lease_duration, now=None):
+    '''
+    Takes the lease of a single activity, creating its entry if it does not
+    exist yet. Claiming an activity already leased by owner renews the lease
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        activity_id (:obj:`str`): identifier of the activity
+        owner (:obj:`str`): identifier of the claiming worker
+        lease_duration (:obj:`int`): lease duration, in seconds
+        now (:obj:`int`, optional): current epoch timestamp
+
+    Returns:
+        True if owner holds the lease, False if another worker does
+
+    '''
+    now = _now(now)
+    con = _connect(sm_database_path)
+    try:
+        cur = con.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.execute('INSERT OR IGNORE INTO STATE_MACHINE (activity_id, is_finished) '\
+                +'VALUES (?, 0)', (activity_id,))
+            cur.execute('UPDATE STATE_MACHINE SET lease_owner = ?, lease_expires = ?, '\
+                +'lease_heartbeat = ? WHERE activity_id = ? AND (lease_owner IS NULL '\
+                +'OR lease_owner = ? OR lease_expires < ?)',
+                        (owner, now+lease_duration, now, activity_id, owner, now))
+            claimed = cur.rowcount == 1
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+    finally:
+        con.close()
+    return claimed
+
+
+def renew_leases(sm_database_path, owner, activity_ids, lease_duration, now=None):
+    '''
+    Extends the leases held by owner and records its heartbeat
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        owner (:obj:`str`): identifier of the worker holding the leases
+        activity_ids (:obj:`list`): ids of the activities to be renewed
+        lease_duration (:obj:`int`): lease duration, in seconds
+        now (:obj:`int`, optional): current epoch timestamp
+
+    Returns:
+        A list with the ids of the activities whose lease is still held by owner
+
+    '''
+    now = _now(now)
+    renewed = []
+    con = _connect(sm_database_path)
+    try:
+        cur = con.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            for activity_id in activity_ids:
+                cur.execute('UPDATE STATE_MACHINE SET lease_expires = ?, lease_heartbeat = ? '\
+                    +'WHERE activity_id = ? AND lease_owner = ?',
+                            (now+lease_duration, now, activity_id, owner))
+                if cur.rowcount == 1:
+                    renewed.append(activity_id)
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+    finally:
+        con.close()
+    return renewed
+
+
+def release_leases(sm_database_path, owner, activity_ids):
+    '''
+    Gives up the leases held by owner, so other workers may claim the activities
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        owner (:obj:`str`): identifier of the worker holding the leases
+        activity_ids (:obj:`list`): ids of the activities to be released
+
+    '''
+    con = sql.connect(sm_database_path)
+    try:
+        with con:
+            con.executemany('UPDATE STATE_MACHINE SET lease_owner = NULL, lease_expires = NULL '\
+                +'WHERE activity_id = ? AND lease_owner = ?',
+                            [(activity_id, owner) for activity_id in activity_ids])
+    finally:
+        con.close()
@@ -5,10 +5,76 @@
 '''
 
 import sqlite3 as sql
-import ast
 import threading
-from time import sleep
+from time import time
 import logging
+from .storage import prepare_database, to_epoch
+from .leases import claim_activity, renew_leases
+from .updates import enqueue_update, fetch_pending_updates, acknowledge_updates
+from .tracing import NULL_SPAN
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+_TABLE_LOCK = threading.Lock()
+
+
+class _TransitionTable(object):
+    '''
+
+    Transition table of a StateMachine subclass, compiled from its
+    _states_methods class attribute. State names are interned and mapped
+    to integer ids, the method of each state is resolved once and the
+    successor of each state is precomputed
+
+    Arguments:
+        sm_class (:obj:`type`): StateMachine subclass that owns the table
+
+    '''
+    __slots__ = ('state_ids', 'state_names', 'methods', 'successors')
+
+    def __init__(self, sm_class):
+        states_methods = sm_class._states_methods
+        if hasattr(states_methods, 'items'):
+            states_methods = states_methods.items()
+        self.state_ids = {}
+        self.state_names = []
+        self.methods = []
+        for state, method_name in states_methods:
+            state = intern(str(state))
+            if state in self.state_ids:
+                raise ValueError('State '+state+' is declared more than once in '\
+                    +sm_class.__name__+'._states_methods')
+            method = getattr(sm_class, method_name, None)
+            if method is None:
+                raise NotImplementedError('The method '+method_name+' corresponding to state '\
+                    +state+' is not implemented in '+sm_class.__name__)
+            if not callable(method):
+                raise TypeError('The attribute '+method_name+' corresponding to state '\
+                    +state+' is not callable')
+            self.state_ids[state] = len(self.state_names)
+            self.state_names.append(state)
+            self.methods.append(method)
+        if not self.state_names:
+            raise ValueError(sm_class.__name__+'._states_methods must declare at least one state')
+        # -1 marks the last state, which has no successor
+        self.successors = list(range(1, len(self.state_names))) + [-1]
+
+    def next_state(self, state):
+        '''
+        Gets the state declared right after state
+
+        Arguments:
+            state (:obj:`str`): name of a declared state
+
+        Returns:
+            The name of the successor state, or None if state is the last one
+
+        '''
+        successor = self.successors[self.state_ids[state]]
+        return self.state_names[successor] if successor >= 0 else None
+
 
 class StateMachine(threading.Thread):
     '''
@@ -20,7 +86,18 @@ class StateMachine(threading.Thread):
         activity_id (:obj:`str`): identifier for the current state
             machine instance
 
+    A child class may declare its states once, at class level, in
+    _states_methods: an ordered sequence of (state, method name) pairs (or an
+    OrderedDict mapping each state to its method name). The sequence is
+    compiled into a transition table the first time the class is instantiated
+    and shared by all of its instances, so the method of each state is not
+    looked up on every execution. Otherwise the child class must fill
+    self._states_methods_dict in its __init__.
+
         '''
+    # MAY be implemented in the child class instead of _states_methods_dict
+    _states_methods = NotImplemented
+
     def __init__(self, sm_database_path, activity_id):
         self.logger = logging.getLogger(activity_id)
         self.activity_id = activity_id
@@ -33,6 +110,7 @@ class StateMachine(threading.Thread):
         self._last_executed_state = None
         # MUST implement in the child class
         self._states_methods_dict = NotImplemented
+        self._transition_table = self._get_transition_table()
         self.sm_fields = NotImplemented
         # Thread class parameters and initialization:
         threading.Thread.__init__(self)
@@ -44,34 +122,97 @@ class StateMachine(threading.Thread):
         self.name = 'state_machine_' + self.activity_id
         # flag that sinalizes an update in the state machine
         self.update_flag = False
+        # Owner of this activity's lease. If None, no lease is taken
+        self.lease_owner = None
+        # Lease duration, in seconds. Each saved state renews the lease, and
+        # run() renews it while waiting for updates
+        self.lease_duration = 30
+        # Time when the lease was last renewed
+        self._lease_renewed_at = None
+        # If True, updates are also read from the durable queue in the database
+        self.durable_updates = False
+        # Maximum number of queued updates handled at once
+        self.update_batch_size = 100
+        # Id of the last queued update handled but not acknowledged yet
+        self._pending_update_id = None
+        # Optional tracing.Tracer that records spans of this state machine
+        self.tracer = None
+        # Cache of activity records read before the database, e.g. the process-wide
+        # cache.ACTIVITY_CACHE. Records changed by other processes are only seen
+        # once invalidated. If None, no cache is used
+        self.activity_cache = None
+        # Set by stop() to make run() return before the activity is finished
+        self._stop_event = threading.Event()
+
+
+    @classmethod
+    def _get_transition_table(cls):
+        '''
+        Gets the transition table of this class, compiling it on first use
 
+        Returns:
+            The class' _TransitionTable, or None if _states_methods is not implemented
+
+        '''
+        table = cls.__dict__.get('_transition_table')
+        if table is None and cls._states_methods is not NotImplemented:
+            with _TABLE_LOCK:
+                table = cls.__dict__.get('_transition_table')
+                if table is None:
+                    table = _TransitionTable(cls)
+                    cls._transition_table = table
+        return table
 
     def _restore_state_from_db(self):
         '''
-        Inspects the data base and tries to restore the thread related to
-        the current activity (activity_id)
+        Inspects the activity cache, then the data base, and tries to restore
+        the thread related to the current activity (activity_id)
 
         '''
         current_state = None
-        con = sql.connect(self._sm_database_path)
-        con.row_factory = sql.Row
-        with con:
-            cur = con.cursor()
-            execute = '''SELECT * FROM STATE_MACHINE WHERE `activity_id` = "'''\
-                +str(self.activity_id)+'''"'''
-            cur.execute(execute)
-        rows = cur.fetchall()
-        if rows:
-            # Fetching fields from data base
-            self.is_finished = ast.literal_eval(rows[0]["is_finished"].encode('utf-8'))
+        record = self._load_activity_record()
+        if record:
+            self.is_finished = record["is_finished"]
             if not self.is_finished:
-                self._external_id = rows[0]["external_id"]
-                current_state = rows[0]["current_state"].encode('utf-8')
+                self._external_id = record["external_id"]
+                current_state = record["current_state"]
             else:
                 logging.warning('The activity with id ' + self.activity_id\
                     +' has been already finished.')
         return current_state
 
+    def _load_activity_record(self):
+        '''
+        Gets the record of this activity from the activity cache or, on a miss,
+        from table STATE_MACHINE, caching it
+
+        Returns:
+            A dictionary with is_finished, current_state and external_id,
+            or None if there is no entry
+
+        '''
+        cache = self.activity_cache
+        if cache is not None:
+            record = cache.get(self._sm_database_path, self.activity_id)
+            if record is not None:
+                return record
+        con = sql.connect(self._sm_database_path)
+        con.row_factory = sql.Row
+        with con:
+            cur = con.cursor()
+            cur.execute('SELECT is_finished, current_state, external_id FROM STATE_MACHINE '\
+                +'WHERE activity_id = ?', (self.__convert_str(self.activity_id),))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        # Fetching fields from data base
+        record = {'is_finished': bool(row["is_finished"]),
+                  'current_state': row["current_state"],
+                  'external_id': row["external_id"]}
+        if cache is not None:
+            cache.put(self._sm_database_path, self.activity_id, record)
+        return record
+
     def get_updated_states(self):
         '''
         This method must be implemented in the child class and return, after an
@@ -79,6 +220,135 @@ class StateMachine(threading.Thread):
         '''
         raise NotImplementedError('This method must be implemented in the child class!')
 
+    def handle_updates(self, payloads):
+        '''
+        This method may be implemented in the child class to apply the payloads
+        of queued updates before get_updated_states is called
+
+        Arguments:
+            payloads (:obj:`list`): payloads of the updates, in the order they were queued
+
+        '''
+        pass
+
+    def post_update(self, payload=None):
+        '''
+        Signals an update through the update_flag and, if durable_updates is
+        True, appends it to the durable queue of this activity
+
+        Arguments:
+            payload (:obj:`str`, optional): data describing the update. It is
+                only kept in the durable queue
+
+        Returns:
+            The id of the queued update, or None if durable_updates is False
+
+        '''
+        update_id = None
+        if self.durable_updates:
+            update_id = enqueue_update(self._sm_database_path, self.activity_id, payload)
+        self.update_flag = True
+        return update_id
+
+    def _span(self, name, **args):
+        '''
+        Opens a tracing span, or a span that records nothing if tracing is off
+
+        Arguments:
+            name (:obj:`str`): name of the span
+            args: extra fields stored in the span
+
+        '''
+        if self.tracer is None:
+            return NULL_SPAN
+        return self.tracer.span(name, activity_id=self.activity_id, **args)
+
+    def _transition(self, name):
+        '''
+        Opens a tracing transition, or a span that records nothing if tracing is off
+
+        Arguments:
+            name (:obj:`str`): name of the transition
+
+        '''
+        if self.tracer is None:
+            return NULL_SPAN
+        return self.tracer.transition(name, activity_id=self.activity_id)
+
+    def _renew_lease(self):
+        '''
+        Renews the lease of this activity once a third of lease_duration
+        has passed since it was last renewed
+
+        Returns:
+            True if the lease is still held (or no lease is taken), False otherwise
+
+        '''
+        if self.lease_owner is None:
+            return True
+        now = time()
+        if self._lease_renewed_at is not None and \
+                now - self._lease_renewed_at < self.lease_duration / 3.0:
+            return True
+        with self._span('renew_lease'):
+            renewed = renew_leases(self._sm_database_path, self.lease_owner,
+                                   [self.activity_id], self.lease_duration)
+        if not renewed:
+            self.logger.error('The lease of activity '+self.activity_id\
+                +' is no longer held by '+self.lease_owner+'. Its thread will be finished.')
+            return False
+        self._lease_renewed_at = now
+        return True
+
+    def _drain_updates(self):
+        '''
+        Fetches a batch of unacknowledged updates from the durable queue and
+        hands their payloads to handle_updates
+
+        Returns:
+            True if there were pending updates, False otherwise, or None if
+            handle_updates failed
+
+        '''
+        # Updates handled but not acknowledged yet are not handed out again
+        with self._span('fetch_pending_updates'):
+            updates = fetch_pending_updates(self._sm_database_path, self.activity_id,
+                                            self.update_batch_size, self._pending_update_id)
+        if not updates:
+            return False
+        try:
+            with self._span('handle_updates'):
+                self.handle_updates([payload for _, payload in updates])
+        except Exception as error:
+            self.logger.error('Error '+str(error)+' while handling the updates of activity '\
+                +self.activity_id+'. Its thread will be finished.')
+            return None
+        self._pending_update_id = updates[-1][0]
+        return True
+
+    def _acknowledge_pending_updates(self):
+        '''
+        Acknowledges the handled updates that did not lead to a new state.
+        If this activity has no entry yet, the updates stay pending and are
+        acknowledged along with its first saved state
+
+        Returns:
+            False if the activity's lease was lost, True otherwise
+
+        '''
+        if self._pending_update_id is None:
+            return True
+        with self._span('acknowledge_updates'):
+            acknowledged = acknowledge_updates(self._sm_database_path, self.activity_id,
+                                               self._pending_update_id, self.lease_owner)
+        if acknowledged:
+            self._pending_update_id = None
+        elif self.lease_owner is not None:
+            self.logger.error('The lease of activity '+self.activity_id\
+                +' is no longer held by '+self.lease_owner+'. Its updates were not acknowledged.')
+            return False
+        return True
+
     def __convert_str(self, str_to_cv):
         '''
         Convert a variable to string(python3) or unicode(python2) representation
@@ -96,98 +366,160 @@ class StateMachine(threading.Thread):
             conv_str = str(str_to_cv)
         return conv_str
 
-    def _exec_state(self, state_to_exec):
+    def _exec_state(self, state_to_exec, update_id=None):
         '''
 
-        Execute the method described in self._states_methods_dict that
-        corresponds to the state state_to_exec
+        Execute the method described in the class' transition table (or in
+        self._states_methods_dict) that corresponds to the state state_to_exec
 
         Arguments:
             state_to_exec (:obj:`string`): state that must have its methods executed.
+            update_id (:obj:`int`, optional): id of the last queued update to be
+                acknowledged along with the state
 
         Returns:
-            True if all methods were executed successfully, False otherwise
+            True if all methods were executed successfully and the state
+            was saved, False otherwise
 
         '''
-        if self._states_methods_dict:
+        table = self._transition_table
+        if table is not None:
             self.logger.debug('The following state will be executed: '+state_to_exec)
-            if state_to_exec in self._states_methods_dict:
-                self.logger.debug('Executing state '+state_to_exec)
-                try:
-                    ret = self._states_methods_dict[state_to_exec]['method']()
-                except Exception as error:
-                    self.logger.error('Error '+str(error)+\
-                        ' while executing state '+state_to_exec)
-                    return False
-                else:
-                    if not ret:
-                        self.logger.error("Error while executing stage "\
-                                +state_to_exec+" from "+" activity's id "\
-                                +self.activity_id+". Its thread will be finished.")
-                        return False
-            else:
+            state_id = table.state_ids.get(state_to_exec)
+            if state_id is None:
+                self.logger.warning('The state '+state_to_exec+' is not declared in '\
+                    +type(self).__name__+'._states_methods.')
+                return False
+            method = table.methods[state_id]
+            args = (self,)
+        elif self._states_methods_dict:
+            self.logger.debug('The following state will be executed: '+state_to_exec)
+            if state_to_exec not in self._states_methods_dict:
                 self.logger.warning('The method corresponding to state '+state_to_exec\
                     +' is not implemented. It must be done in the super class.')
                 return False
-            self._save_state_to_db(state_to_exec)
-            return True
+            method = self._states_methods_dict[state_to_exec]['method']
+            args = ()
         else:
             self.logger.error('Error! You must fill properly the states`s methods'\
                 +' dictionary self._states_methods_dict in the super class!')
             return False
+        self.logger.debug('Executing state '+state_to_exec)
+        try:
+            with self._span('exec_state', state=state_to_exec):
+                ret = method(*args)
+        except Exception as error:
+            self.logger.error('Error '+str(error)+\
+                ' while executing state '+state_to_exec)
+            return False
+        if not ret:
+            self.logger.error("Error while executing stage "\
+                    +state_to_exec+" from "+" activity's id "\
+                    +self.activity_id+". Its thread will be finished.")
+            return False
+        with self._span('save_state', state=state_to_exec):
+            return self._save_state_to_db(state_to_exec, update_id)
 
-    def __check_activity_in_db(self):
+    def _save_state_to_db(self, current_state, update_id=None):
         '''
-        Checks if there is an entry in table STATE_MACHINE in the database corresponding
-        to this activity_id
+
+        Saves necessary fields of this activity into the database, in table STATE_MACHINE.
+        The entry is created if it does not exist, and the queued updates up to
+        update_id are acknowledged in the same transaction
+
+        Arguments:
+            current_state (:obj:`str`): state that has just been executed
+            update_id (:obj:`int`, optional): id of the last queued update to be
+                acknowledged
 
         Returns:
-            True if there is an entry, False otherwise
+            True if the state was saved, False otherwise (e.g. the activity's lease was lost)
 
         '''
         con = sql.connect(self._sm_database_path)
+        self.logger.debug('Saving activity '+self.activity_id+' state to database')
+        self.current_state = current_state
+        activity_id = self.__convert_str(self.activity_id)
+        activity_name = self.__convert_str(self.sm_fields['activity_name'])
+        activity_creation_date = to_epoch(self.sm_fields['activity_creation_date'])
+        external_id = None if self._external_id is None else self.__convert_str(self._external_id)
+        # activity_name and activity_creation_date are only filled when the
+        # entry has just been created, here or by claim_activity
+        query = 'UPDATE STATE_MACHINE SET current_state = ?, is_finished = ?, '\
+            +'current_state_creation_date = ?, external_id = ?, '\
+            +'activity_name = COALESCE(activity_name, ?), '\
+            +'activity_creation_date = COALESCE(activity_creation_date, ?)'
+        params = [self.__convert_str(current_state),
+                  int(self.is_finished),
+                  to_epoch(self.sm_fields.get('current_state_creation_date')),
+                  external_id,
+                  activity_name,
+                  activity_creation_date]
+        if update_id is not None:
+            query += ', last_update_id = MAX(last_update_id, ?)'
+            params.append(update_id)
         with con:
             cur = con.cursor()
-            cur.execute("SELECT * FROM STATE_MACHINE WHERE `activity_id` = '" \
-                + self.activity_id+"'")
-        rows = cur.fetchall()
-        return True if rows else False
+            if self.lease_owner is None:
+                cur.execute('INSERT OR IGNORE INTO STATE_MACHINE (activity_id, activity_name, '\
+                    +'activity_creation_date) VALUES (?, ?, ?)',
+                            (activity_id, activity_name, activity_creation_date))
+                query += ' WHERE activity_id = ?'
+                params.append(activity_id)
+            else:
+                # The entry is created by claim_activity. Saving renews the lease,
+                # and fails if another worker took it over
+                now = int(time())
+                query += ', lease_expires = ?, lease_heartbeat = ? '\
+                    +'WHERE activity_id = ? AND lease_owner = ?'
+                params.extend([now+self.lease_duration, now, activity_id, self.lease_owner])
+            cur.execute(query, params)
+            saved = cur.rowcount == 1
+        if not saved:
+            if self.lease_owner is not None:
+                self.logger.error('The lease of activity '+self.activity_id\
+                    +' is no longer held by '+self.lease_owner+'. Its state was not saved.')
+            else:
+                self.logger.error('The state of activity '+self.activity_id+' was not saved.')
+            if self.activity_cache is not None:
+                self.activity_cache.invalidate(self._sm_database_path, self.activity_id)
+            return False
+        if self.lease_owner is not None:
+            self._lease_renewed_at = now
+        if self.activity_cache is not None:
+            self.activity_cache.put(self._sm_database_path, self.activity_id,
+                                    {'is_finished': bool(self.is_finished),
+                                     'current_state': current_state,
+                                     'external_id': external_id})
+        return True
 
-    def _save_state_to_db(self, current_state):
+    def _save_finished_to_db(self):
         '''
+        Marks this activity as finished in table STATE_MACHINE, so it is
+        neither restored nor claimed again
 
-        Saves necessary fields of this activity into the database, in table STATE_MACHINE
+        Returns:
+            True if the entry was marked, False otherwise (e.g. the activity's lease was lost)
 
         '''
-        entry_exist = self.__check_activity_in_db()
+        query = 'UPDATE STATE_MACHINE SET is_finished = 1 WHERE activity_id = ?'
+        params = [self.__convert_str(self.activity_id)]
+        if self.lease_owner is not None:
+            query += ' AND lease_owner = ?'
+            params.append(self.lease_owner)
         con = sql.connect(self._sm_database_path)
-        self.logger.debug('Saving activity '+self.activity_id+' state to database')
-        self.current_state = current_state
-        with con:
-            cur = con.cursor()
-            if not entry_exist:
-                sm_table_fields_list = [
-                    self.__convert_str(self.sm_fields['activity_name']),  # activity_name
-                    self.__convert_str(self.is_finished),  # is_finished
-                    self.__convert_str(current_state),  # current_state
-                    self.__convert_str(self.activity_id),  # activity_id
-                    self.__convert_str((self.sm_fields['activity_creation_date']).strftime(
-                        "%Y-%m-%d %H:%M:%S")),  # creationDate
-                    self.__convert_str(self.sm_fields['current_state_creation_date'].\
-                        strftime("%Y-%m-%d %H:%M:%S")),
-                    self.__convert_str(self._external_id)  # external_id
-                ]
-                cur.execute("INSERT INTO STATE_MACHINE VALUES("\
-                    +'"'+'", "'.join(sm_table_fields_list)+'"'+")")
-            else:
-                cur.execute("UPDATE STATE_MACHINE SET "\
-                    +"current_state = '"+self.__convert_str(current_state)+"',"\
-                    +"is_finished = '"+self.__convert_str(self.is_finished)+"',"\
-                    +"current_state_creation_date = '"\
-                        +self.__convert_str(self.sm_fields['current_state_creation_date'].\
-                        strftime("%Y-%m-%d %H:%M:%S"))+"',"\
-                    +"external_id = '"+self.__convert_str(self._external_id)+"' "\
-                    +"WHERE activity_id = '" + self.__convert_str(self.activity_id)+"'")
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute(query, params)
+                saved = cur.rowcount == 1
+        finally:
+            con.close()
+        if self.activity_cache is not None:
+            self.activity_cache.invalidate(self._sm_database_path, self.activity_id)
+        if not saved:
+            self.logger.error('The activity '+self.activity_id+' was not marked as finished.')
+        return saved
 
     def _synchronize_states(self):
         '''
@@ -197,22 +529,73 @@ class StateMachine(threading.Thread):
         '''
 
         self.logger.info("Synchronizing activity's id "+self.activity_id+" ...")
-        states_list = self.get_updated_states()
-        restored_current_state = self._restore_state_from_db()
+        prepare_database(self._sm_database_path)
+        if self.lease_owner is not None:
+            with self._span('claim_activity'):
+                claimed = claim_activity(self._sm_database_path, self.activity_id,
+                                         self.lease_owner, self.lease_duration)
+            if not claimed:
+                self.logger.warning('The activity with id '+self.activity_id\
+                    +' is leased by another worker.')
+                return False
+            self._lease_renewed_at = time()
+            # Another worker may have written the entry since it was cached
+            if self.activity_cache is not None:
+                self.activity_cache.invalidate(self._sm_database_path, self.activity_id)
+        if self.durable_updates:
+            # Replays the updates that were not acknowledged before a restart
+            if self._drain_updates() is None:
+                return False
+        with self._span('get_updated_states'):
+            states_list = self.get_updated_states()
+        with self._span('restore_state'):
+            restored_current_state = self._restore_state_from_db()
         self.update_flag = False
         if not self.is_finished:
+            self._last_executed_state = restored_current_state
             if not restored_current_state == states_list[-1]:
-                if restored_current_state:
-                    states_to_exec_list = states_list[states_list.index(restored_current_state)+1:]
-                else:
-                    states_to_exec_list = states_list
-                for state in states_to_exec_list:
-                    ret = self._exec_state(state)
-                    if not ret:
-                        return False
-                    self._last_executed_state = state
-            else:
-                self._last_executed_state = restored_current_state
+                states_to_exec_list = self._get_states_to_exec(states_list,
+                                                               restored_current_state)
+                if not self._exec_states(states_to_exec_list):
+                    return False
+        return self._acknowledge_pending_updates()
+
+    def _get_states_to_exec(self, states_list, last_state):
+        '''
+        Gets the states of states_list that follow last_state
+
+        Arguments:
+            states_list (:obj:`list`): states returned by get_updated_states
+            last_state (:obj:`str`): last executed state, or None
+
+        Returns:
+            The list of states to be executed
+
+        '''
+        if last_state:
+            return states_list[states_list.index(last_state)+1:]
+        return states_list
+
+    def _exec_states(self, states_to_exec_list):
+        '''
+        Executes each state of states_to_exec_list, in order. The last saved
+        state acknowledges the queued updates handled so far
+
+        Arguments:
+            states_to_exec_list (:obj:`list`): states to be executed
+
+        Returns:
+            True if all states were executed successfully, False otherwise
+
+        '''
+        last_index = len(states_to_exec_list) - 1
+        for index, state in enumerate(states_to_exec_list):
+            update_id = self._pending_update_id if index == last_index else None
+            if not self._exec_state(state, update_id):
+                return False
+            self._last_executed_state = state
+        if states_to_exec_list:
+            self._pending_update_id = None
         return True
 
     def _execute_current_actions(self):
@@ -222,42 +605,70 @@ class StateMachine(threading.Thread):
 
         '''
         self.update_flag = False
-        states_list = self.get_updated_states()
+        with self._span('get_updated_states'):
+            states_list = self.get_updated_states()
         if not self.is_finished:
             if not self._last_executed_state == states_list[-1]:
-                states_to_exec_list = states_list[states_list.index(self._last_executed_state)+1:]
-                for state in states_to_exec_list:
-                    ret = self._exec_state(state)
-                    if not ret:
-                        return False
-                    self._last_executed_state = state
+                states_to_exec_list = self._get_states_to_exec(states_list,
+                                                               self._last_executed_state)
+                if not self._exec_states(states_to_exec_list):
+                    return False
         else:
             self.logger.info("Activity's id "+self.activity_id+" thread is finished.")
-        return True
+        return self._acknowledge_pending_updates()
 
     def run(self):
         '''
         Initiates the thread that effectivelly implements the state machine.
         A change of state must be sinalized by a flag (update, must be True)
-        The final state must be sinalized by a flag (is_finished, must be True)
+        or, if durable_updates is True, by an update queued in the database.
+        If a tracer is set, the synchronization and each execution of the
+        updated states, along with the updates it handles, are traced as transitions
+        The final state must be sinalized by a flag (is_finished, must be True),
+        which is then saved to the database. Calling stop makes it return
+        without finishing the activity
 
         '''
         if self.sm_fields == NotImplemented:
             raise NotImplementedError('Must implement sm_fields dictionary in the child class!')
-        if self._states_methods_dict == NotImplemented:
+        if self._states_methods_dict == NotImplemented and self._transition_table is None:
             raise NotImplementedError('Must implement _states_methods_dict dictionary'\
-                                      +'in the child class!')
-        if not self._synchronize_states():
-            return
+                                      +' or _states_methods in the child class!')
+        with self._transition('synchronize_states'):
+            if not self._synchronize_states():
+                return
         while not self.is_finished:
+            if self._stop_event.is_set():
+                self.logger.info("Activity's id "+self.activity_id+" thread is stopped.")
+                return
+            if not self._renew_lease():
+                return
             mlock = threading.RLock()
             with mlock:
-                if self.update_flag:
-                    if not self._execute_current_actions():
-                        return
-            sleep(self.sleep_interval)
+                if self.update_flag or self.durable_updates:
+                    with self._transition('execute_current_actions') as transition:
+                        drained = self.durable_updates and self._drain_updates()
+                        if drained is None:
+                            return
+                        if self.update_flag or drained:
+                            if not self._execute_current_actions():
+                                return
+                        else:
+                            # Polling an empty queue is not traced
+                            transition.discard()
+            self._stop_event.wait(self.sleep_interval)
+        with self._span('save_finished'):
+            self._save_finished_to_db()
         self.logger.info("Activity's id "+self.activity_id+" thread is finished.")
 
+    def stop(self):
+        '''
+        Signals the thread to return once the states being executed are
+        saved, leaving the activity unfinished so it can be resumed later
+
+        '''
+        self._stop_event.set()
+
     @staticmethod
     def check_if_thread_alive(activity_id):
         '''
@@ -0,0 +1,268 @@
+'''
+    This module defines the layout of the STATE_MACHINE table and
+    migrates databases created with older layouts to the current one
+
+'''
+
+import sqlite3 as sql
+import os
+import threading
+import logging
+import calendar
+from datetime import datetime
+from time import mktime
+
+# Version of the database layout, stored in sqlite's user_version pragma.
+# Version 0 is the legacy layout, which stores every field as text
+SCHEMA_VERSION = 3
+
+_CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS STATE_MACHINE (
+    activity_name TEXT,
+    is_finished INTEGER NOT NULL DEFAULT 0,
+    current_state TEXT,
+    activity_id TEXT NOT NULL PRIMARY KEY,
+    activity_creation_date INTEGER,
+    current_state_creation_date INTEGER,
+    external_id TEXT,
+    lease_owner TEXT,
+    lease_expires INTEGER,
+    lease_heartbeat INTEGER,
+    last_update_id INTEGER NOT NULL DEFAULT 0)'''
+
+# Append-only queue of inbound updates. The updates of an activity up to its
+# STATE_MACHINE.last_update_id have been acknowledged
+_CREATE_UPDATES_TABLE = '''CREATE TABLE IF NOT EXISTS STATE_MACHINE_UPDATES (
+    update_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    activity_id TEXT NOT NULL,
+    payload TEXT,
+    creation_date INTEGER)'''
+
+_COLUMNS = ('activity_name', 'is_finished', 'current_state', 'activity_id',
+            'activity_creation_date', 'current_state_creation_date', 'external_id')
+
+# Statements that upgrade a typed layout from the version in the key to the next one
+_UPGRADES = {
+    1: ('ALTER TABLE STATE_MACHINE ADD COLUMN lease_owner TEXT',
+        'ALTER TABLE STATE_MACHINE ADD COLUMN lease_expires INTEGER',
+        'ALTER TABLE STATE_MACHINE ADD COLUMN lease_heartbeat INTEGER'),
+    2: ('ALTER TABLE STATE_MACHINE ADD COLUMN last_update_id INTEGER NOT NULL DEFAULT 0',),
+}
+
+# Statements run along with the creation or upgrade of STATE_MACHINE
+_AUXILIARY_STATEMENTS = (
+    _CREATE_UPDATES_TABLE,
+    'CREATE INDEX IF NOT EXISTS STATE_MACHINE_UPDATES_activity_id '\
+        +'ON STATE_MACHINE_UPDATES (activity_id, update_id)',
+    'CREATE INDEX IF NOT EXISTS STATE_MACHINE_is_finished ON STATE_MACHINE (is_finished)',
+    'CREATE INDEX IF NOT EXISTS STATE_MACHINE_activity_creation_date '\
+        +'ON STATE_MACHINE (activity_creation_date)',
+    'CREATE INDEX IF NOT EXISTS STATE_MACHINE_current_state_creation_date '\
+        +'ON STATE_MACHINE (current_state_creation_date)',
+    'CREATE INDEX IF NOT EXISTS STATE_MACHINE_lease ON STATE_MACHINE (is_finished, lease_expires)',
+)
+
+_LEGACY_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Identity of the file of each prepared database, by real path
+_PREPARED_DATABASES = {}
+_PREPARE_LOCK = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def to_epoch(date):
+    '''
+    Converts a datetime to an integer epoch timestamp
+
+    Arguments:
+        date (:obj:`datetime`): date to be converted. Naive dates are
+            taken as local time
+
+    Returns:
+        The number of seconds since the epoch, or None if date is None
+
+    '''
+    if date is None:
+        return None
+    if date.tzinfo is not None:
+        return calendar.timegm(date.utctimetuple())
+    return int(mktime(date.timetuple()))
+
+
+def from_epoch(timestamp):
+    '''
+    Converts an integer epoch timestamp to a naive local datetime
+
+    Arguments:
+        timestamp (:obj:`int`): number of seconds since the epoch
+
+    Returns:
+        The corresponding datetime, or None if timestamp is None
+
+    '''
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp)
+
+
+def _legacy_value(value):
+    '''
+    Converts the text representation of None used by the legacy layout
+
+    '''
+    if value is None or value == 'None':
+        return None
+    return value
+
+
+def _legacy_date(value):
+    '''
+    Converts a date stored as text by the legacy layout to an epoch timestamp
+
+    '''
+    value = _legacy_value(value)
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return to_epoch(datetime.strptime(value, _LEGACY_DATE_FORMAT))
+    except ValueError:
+        logger.warning('Discarding unparseable date '+value+' while migrating')
+        return None
+
+
+def _legacy_bool(value):
+    '''
+    Converts a boolean stored as text by the legacy layout to an integer
+
+    '''
+    value = _legacy_value(value)
+    if value in (None, 'False', '0', 0):
+        return 0
+    return 1
+
+
+def _migrate_legacy_table(cur):
+    '''
+    Copies the rows of a legacy STATE_MACHINE table into a typed one
+
+    '''
+    cur.execute('ALTER TABLE STATE_MACHINE RENAME TO STATE_MACHINE_LEGACY')
+    cur.execute(_CREATE_TABLE)
+    cur.execute('SELECT * FROM STATE_MACHINE_LEGACY')
+    columns = [description[0] for description in cur.description]
+    rows = {}
+    for legacy_row in cur.fetchall():
+        row = dict(zip(columns, legacy_row))
+        activity_id = _legacy_value(row.get('activity_id'))
+        if activity_id is None:
+            logger.warning('Skipping a legacy row without activity_id while migrating: '\
+                +str(row))
+            continue
+        if activity_id in rows:
+            logger.warning('Dropping a duplicated legacy row of activity '+str(activity_id)\
+                +' while migrating; only its last row is kept')
+        # Some early layouts named the current state "present_state"
+        current_state = row.get('current_state', row.get('present_state'))
+        current_state_date = row.get('current_state_creation_date',
+                                     row.get('present_state_creation_date'))
+        rows[activity_id] = (
+            _legacy_value(row.get('activity_name')),
+            _legacy_bool(row.get('is_finished')),
+            _legacy_value(current_state),
+            activity_id,
+            _legacy_date(row.get('activity_creation_date')),
+            _legacy_date(current_state_date),
+            _legacy_value(row.get('external_id')))
+    cur.executemany('INSERT INTO STATE_MACHINE ('+', '.join(_COLUMNS)\
+        +') VALUES (?, ?, ?, ?, ?, ?, ?)', list(rows.values()))
+    cur.execute('DROP TABLE STATE_MACHINE_LEGACY')
+    return len(rows)
+
+
+def migrate_database(sm_database_path):
+    '''
+    Creates the STATE_MACHINE table, or converts an existing legacy one
+    (text fields, 'True'/'False' booleans, formatted dates and 'None'
+    strings) to native column types, upgrades older typed layouts and
+    creates its indexes and the updates queue
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+
+    Returns:
+        The number of migrated rows
+
+    '''
+    migrated = 0
+    con = sql.connect(sm_database_path)
+    # Transactions are handled explicitly, so the DDL is atomic as well
+    con.isolation_level = None
+    try:
+        cur = con.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.execute('PRAGMA user_version')
+            version = cur.fetchone()[0]
+            if version < SCHEMA_VERSION:
+                cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' "\
+                    +"AND name = 'STATE_MACHINE'")
+                table_exists = cur.fetchone() is not None
+                if version == 0 and table_exists:
+                    migrated = _migrate_legacy_table(cur)
+                    logger.info('Migrated '+str(migrated)+' activities of '\
+                        +sm_database_path+' to schema version '+str(SCHEMA_VERSION))
+                elif version == 0 or not table_exists:
+                    cur.execute(_CREATE_TABLE)
+                else:
+                    for step in range(version, SCHEMA_VERSION):
+                        for statement in _UPGRADES[step]:
+                            cur.execute(statement)
+                for statement in _AUXILIARY_STATEMENTS:
+                    cur.execute(statement)
+                cur.execute('PRAGMA user_version = '+str(SCHEMA_VERSION))
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+    finally:
+        con.close()
+    return migrated
+
+
+def _database_identity(sm_database_path):
+    '''
+    Identifies the file of a database, so a file that was deleted and
+    created again is not taken as already prepared
+
+    Returns:
+        A (real path, identity) tuple. identity is None if the file does not
+        exist or is empty
+
+    '''
+    path = os.path.realpath(sm_database_path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None
+    if not stat.st_size:
+        return path, None
+    return path, (stat.st_dev, stat.st_ino)
+
+
+def prepare_database(sm_database_path):
+    '''
+    Makes sure the database uses the current layout, migrating it
+    at most once per process and database file
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+
+    '''
+    path, identity = _database_identity(sm_database_path)
+    if identity is not None and _PREPARED_DATABASES.get(path) == identity:
+        return
+    with _PREPARE_LOCK:
+        path, identity = _database_identity(sm_database_path)
+        if identity is None or _PREPARED_DATABASES.get(path) != identity:
+            migrate_database(sm_database_path)
+            _PREPARED_DATABASES[path] = _database_identity(sm_database_path)[1]
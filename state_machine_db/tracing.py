@@ -0,0 +1,233 @@
+'''
+    This module implements an opt-in tracer that records spans around the
+    steps of a state machine and keeps only the slow transitions
+
+'''
+
+import json
+import os
+import random
+import threading
+from collections import deque
+from time import time
+
+
+class _NullSpan(object):
+    '''
+    Span that records nothing, used when tracing is off or not sampled
+
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def discard(self):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    '''
+    Times a block of code and hands the resulting record to its tracer
+
+    '''
+    __slots__ = ('_tracer', '_name', '_args', '_start')
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time() - self._start
+        args = self._args
+        if exc_type is not None:
+            args = dict(args, error=repr(exc_value))
+        self._tracer._record({'name': self._name,
+                              'start': self._start,
+                              'duration': duration,
+                              'thread': threading.current_thread().ident,
+                              'args': args})
+        return False
+
+
+class _Transition(object):
+    '''
+    Collects the spans recorded in its block and keeps them only if the
+    whole block lasted at least the tracer's threshold and was not discarded
+
+    '''
+    __slots__ = ('_tracer', '_span', '_previous', '_discarded')
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._span = _Span(tracer, name, args)
+        self._previous = None
+        self._discarded = False
+
+    def __enter__(self):
+        local = self._tracer._local
+        self._previous = getattr(local, 'buffer', None)
+        if random.random() < self._tracer.sample_rate:
+            local.buffer = []
+            self._span.__enter__()
+        else:
+            local.buffer = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        local = self._tracer._local
+        buffer = local.buffer
+        if buffer is not False:
+            self._span.__exit__(exc_type, exc_value, traceback)
+        local.buffer = self._previous
+        if buffer and not self._discarded:
+            transition = buffer[-1]
+            if transition['duration'] >= self._tracer.threshold:
+                self._tracer._keep(buffer)
+        return False
+
+    def discard(self):
+        '''
+        Drops the spans of this transition, e.g. when it turned out to do nothing
+
+        '''
+        self._discarded = True
+
+
+class Tracer(object):
+    '''
+
+    Records spans into a bounded ring buffer. Spans recorded inside a
+    transition are kept only if the transition lasted at least threshold
+    seconds (tail sampling), and only a sample_rate fraction of the
+    transitions, and of the spans recorded outside of them, is timed at all
+
+    Arguments:
+        threshold (:obj:`float`, optional): minimum duration, in seconds, of
+            the transitions to be kept
+        sample_rate (:obj:`float`, optional): fraction of the transitions
+            and standalone spans to be timed, between 0 and 1
+        max_spans (:obj:`int`, optional): capacity of the ring buffer. The
+            oldest spans are discarded once it is full
+
+        '''
+    def __init__(self, threshold=0.0, sample_rate=1.0, max_spans=10000):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def transition(self, name, **args):
+        '''
+        Opens a transition, whose spans are kept or discarded together
+
+        Arguments:
+            name (:obj:`str`): name of the transition
+            args: extra fields stored in the transition's span
+
+        Returns:
+            A context manager
+
+        '''
+        return _Transition(self, name, args)
+
+    def span(self, name, **args):
+        '''
+        Opens a span. Spans recorded outside of a transition are sampled
+        like transitions, and kept if they last at least threshold seconds
+
+        Arguments:
+            name (:obj:`str`): name of the span
+            args: extra fields stored in the span
+
+        Returns:
+            A context manager
+
+        '''
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is False or (buffer is None and random.random() >= self.sample_rate):
+            return NULL_SPAN
+        return _Span(self, name, args)
+
+    def _record(self, span):
+        '''
+        Stores a finished span in the current transition, or in the ring
+        buffer if no transition is open
+
+        '''
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            if span['duration'] >= self.threshold:
+                self._keep([span])
+        elif buffer is not False:
+            buffer.append(span)
+
+    def _keep(self, spans):
+        '''
+        Appends spans to the ring buffer
+
+        '''
+        with self._lock:
+            self._spans.extend(spans)
+
+    def spans(self):
+        '''
+        Gets the spans kept so far, oldest first
+
+        Returns:
+            A list of dictionaries with the name, start (epoch seconds),
+            duration (seconds), thread and args of each span
+
+        '''
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        '''
+        Discards the spans kept so far
+
+        '''
+        with self._lock:
+            self._spans.clear()
+
+    def dump_json(self):
+        '''
+        Serializes the spans kept so far
+
+        Returns:
+            A JSON string with the list of spans
+
+        '''
+        return json.dumps(self.spans(), default=str)
+
+    def dump_chrome_trace(self):
+        '''
+        Serializes the spans kept so far in the Chrome trace event format,
+        which can be loaded in chrome://tracing or Perfetto
+
+        Returns:
+            A JSON string with a traceEvents list of complete events
+
+        '''
+        pid = os.getpid()
+        events = [{'name': span['name'],
+                   'ph': 'X',
+                   'ts': int(span['start']*1e6),
+                   'dur': int(span['duration']*1e6),
+                   'pid': pid,
+                   'tid': span['thread'],
+                   'args': span['args']} for span in self.spans()]
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str)
@@ -0,0 +1,151 @@
+'''
+    This module implements the durable queue of inbound updates. Updates
+    are appended to STATE_MACHINE_UPDATES and acknowledged by moving the
+    last_update_id watermark of their activity, so a restart only replays
+    the updates that were not acknowledged
+
+'''
+
+import sqlite3 as sql
+from time import time
+from .storage import prepare_database
+
+
+def enqueue_update(sm_database_path, activity_id, payload=None, now=None):
+    '''
+    Appends an update to the queue of an activity
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        activity_id (:obj:`str`): identifier of the updated activity
+        payload (:obj:`str`, optional): data describing the update
+        now (:obj:`int`, optional): current epoch timestamp
+
+    Returns:
+        The id of the queued update
+
+    '''
+    prepare_database(sm_database_path)
+    con = sql.connect(sm_database_path)
+    try:
+        with con:
+            cur = con.cursor()
+            cur.execute('INSERT INTO STATE_MACHINE_UPDATES (activity_id, payload, creation_date) '\
+                +'VALUES (?, ?, ?)', (activity_id, payload, int(time()) if now is None else now))
+            update_id = cur.lastrowid
+    finally:
+        con.close()
+    return update_id
+
+
+def fetch_pending_updates(sm_database_path, activity_id, limit, after_id=None):
+    '''
+    Gets the oldest updates of an activity that were not acknowledged yet
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        activity_id (:obj:`str`): identifier of the activity
+        limit (:obj:`int`): maximum number of updates to be fetched
+        after_id (:obj:`int`, optional): only updates queued after this one
+            are fetched, even if it was not acknowledged yet
+
+    Returns:
+        A list of (update_id, payload) tuples, in the order they were queued
+
+    '''
+    prepare_database(sm_database_path)
+    con = sql.connect(sm_database_path)
+    try:
+        cur = con.cursor()
+        cur.execute('SELECT update_id, payload FROM STATE_MACHINE_UPDATES '\
+            +'WHERE activity_id = ? AND update_id > MAX(COALESCE((SELECT last_update_id '\
+            +'FROM STATE_MACHINE WHERE activity_id = ?), 0), ?) ORDER BY update_id LIMIT ?',
+                    (activity_id, activity_id, after_id or 0, limit))
+        updates = cur.fetchall()
+    finally:
+        con.close()
+    return updates
+
+
+def acknowledge_updates(sm_database_path, activity_id, update_id, owner=None):
+    '''
+    Acknowledges the updates of an activity up to update_id. State machines
+    acknowledge their updates while saving their state; this is only needed
+    when an update did not lead to a new state
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        activity_id (:obj:`str`): identifier of the activity
+        update_id (:obj:`int`): id of the last acknowledged update
+        owner (:obj:`str`, optional): if given, the acknowledgement only
+            happens while owner holds the activity's lease
+
+    Returns:
+        True if the updates were acknowledged, False otherwise
+
+    '''
+    query = 'UPDATE STATE_MACHINE SET last_update_id = MAX(last_update_id, ?) '\
+        +'WHERE activity_id = ?'
+    params = [update_id, activity_id]
+    if owner is not None:
+        query += ' AND lease_owner = ?'
+        params.append(owner)
+    con = sql.connect(sm_database_path)
+    try:
+        with con:
+            cur = con.cursor()
+            cur.execute(query, params)
+            acknowledged = cur.rowcount == 1
+    finally:
+        con.close()
+    return acknowledged
+
+
+def activities_with_pending_updates(sm_database_path, limit):
+    '''
+    Gets the unfinished activities that have updates waiting to be acknowledged
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        limit (:obj:`int`): maximum number of activities to be returned
+
+    Returns:
+        A list with the ids of the activities
+
+    '''
+    prepare_database(sm_database_path)
+    con = sql.connect(sm_database_path)
+    try:
+        cur = con.cursor()
+        cur.execute('SELECT DISTINCT upd.activity_id FROM STATE_MACHINE_UPDATES upd '\
+            +'LEFT JOIN STATE_MACHINE sm ON sm.activity_id = upd.activity_id '\
+            +'WHERE COALESCE(sm.is_finished, 0) = 0 '\
+            +'AND upd.update_id > COALESCE(sm.last_update_id, 0) LIMIT ?', (limit,))
+        activity_ids = [row[0] for row in cur.fetchall()]
+    finally:
+        con.close()
+    return activity_ids
+
+
+def purge_acknowledged_updates(sm_database_path):
+    '''
+    Deletes the updates that were already acknowledged
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+
+    Returns:
+        The number of deleted updates
+
+    '''
+    con = sql.connect(sm_database_path)
+    try:
+        with con:
+            cur = con.cursor()
+            cur.execute('DELETE FROM STATE_MACHINE_UPDATES WHERE update_id <= '\
+                +'(SELECT last_update_id FROM STATE_MACHINE '\
+                +'WHERE STATE_MACHINE.activity_id = STATE_MACHINE_UPDATES.activity_id)')
+            deleted = cur.rowcount
+    finally:
+        con.close()
+    return deleted
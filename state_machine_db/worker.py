@@ -0,0 +1,133 @@
+'''
+    This module implements a worker that claims activities from a shared
+    database and resumes them, so several processes can run the same
+    state machine database
+
+'''
+
+import threading
+import logging
+from .storage import prepare_database
+from .leases import default_owner, claim_activities, renew_leases, release_leases
+
+
+class StateMachineWorker(threading.Thread):
+    '''
+
+    Claims batches of unowned (or expired) activities and runs a state
+    machine for each of them, renewing their leases while they are alive.
+    Activities of a worker that dies are claimed again by the other workers
+    once their leases expire.
+
+    Arguments:
+        sm_database_path (:obj:`str`): path to the sqlite database
+        sm_factory (:obj:`callable`): called with sm_database_path and an
+            activity_id, must return the StateMachine that runs the activity
+        owner (:obj:`str`, optional): identifier of this worker. Defaults to
+            one built from the host name and the process id
+        batch_size (:obj:`int`, optional): maximum number of activities
+            claimed at once
+        max_machines (:obj:`int`, optional): maximum number of state
+            machines running at the same time
+        lease_duration (:obj:`int`, optional): lease duration, in seconds
+
+        '''
+    def __init__(self, sm_database_path, sm_factory, owner=None, batch_size=10,
+                 max_machines=100, lease_duration=30):
+        self.owner = owner if owner is not None else default_owner()
+        self.logger = logging.getLogger('state_machine_worker_'+self.owner)
+        self._sm_database_path = sm_database_path
+        self._sm_factory = sm_factory
+        self.batch_size = batch_size
+        self.max_machines = max_machines
+        self.lease_duration = lease_duration
+        # Running state machines, by activity_id
+        self.machines = {}
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # Time between each heartbeat, must be well below lease_duration
+        self.sleep_interval = max(lease_duration / 3.0, 0.001)
+        self.name = 'state_machine_worker_'+self.owner
+        self._stop_event = threading.Event()
+
+    def claim(self):
+        '''
+        Claims a batch of activities, limited by the free capacity of this
+        worker, and starts a state machine for each one of them
+
+        Returns:
+            A list with the ids of the claimed activities
+
+        '''
+        capacity = min(self.batch_size, self.max_machines - len(self.machines))
+        if capacity <= 0:
+            return []
+        activity_ids = claim_activities(self._sm_database_path, self.owner,
+                                        capacity, self.lease_duration)
+        for activity_id in activity_ids:
+            machine = self._sm_factory(self._sm_database_path, activity_id)
+            machine.lease_owner = self.owner
+            machine.lease_duration = self.lease_duration
+            self.machines[activity_id] = machine
+            self.logger.debug('Resuming activity '+activity_id)
+            machine.start()
+        return activity_ids
+
+    def heartbeat(self):
+        '''
+        Renews the leases of the running state machines and releases the
+        leases of the finished ones. The lease of an activity whose state
+        machine stopped before finishing (e.g. a failed state) is kept until
+        it expires, so it is retried at most once per lease_duration
+
+        '''
+        stopped = [activity_id for activity_id, machine in self.machines.items()
+                   if not machine.is_alive()]
+        finished = []
+        for activity_id in stopped:
+            if self.machines.pop(activity_id).is_finished:
+                finished.append(activity_id)
+            else:
+                self.logger.warning('The state machine of activity '+activity_id\
+                    +' stopped before finishing. Its lease is kept until it expires.')
+        if finished:
+            release_leases(self._sm_database_path, self.owner, finished)
+        alive = list(self.machines)
+        if alive:
+            renewed = renew_leases(self._sm_database_path, self.owner, alive,
+                                   self.lease_duration)
+            for activity_id in set(alive) - set(renewed):
+                self.logger.warning('Lost the lease of activity '+activity_id)
+
+    def stop(self):
+        '''
+        Signals the worker to stop claiming activities, to stop its state
+        machines and to release their leases
+
+        '''
+        self._stop_event.set()
+
+    def run(self):
+        '''
+        Initiates the thread that keeps claiming activities and renewing leases
+        until stop is called. The leases of the state machines that do not
+        stop within lease_duration are kept until they expire
+
+        '''
+        prepare_database(self._sm_database_path)
+        while not self._stop_event.is_set():
+            self.heartbeat()
+            self.claim()
+            self._stop_event.wait(self.sleep_interval)
+        for machine in self.machines.values():
+            machine.stop()
+        stopped = []
+        for activity_id, machine in self.machines.items():
+            machine.join(self.lease_duration)
+            if machine.is_alive():
+                self.logger.warning('The state machine of activity '+activity_id\
+                    +' did not stop. Its lease is kept until it expires.')
+            else:
+                stopped.append(activity_id)
+        release_leases(self._sm_database_path, self.owner, stopped)
+        self.logger.info('Worker '+self.owner+' is finished.')
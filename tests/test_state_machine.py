@@ -2,10 +2,20 @@
 import unittest
 import sqlite3 as sql
 import os
+import shutil
+import tempfile
+import json
 from datetime import datetime
-from time import sleep
+from time import sleep, time
 from collections import OrderedDict
-from state_machine_db import StateMachine
+from state_machine_db import (StateMachine, StateMachineWorker, ActivityCache,
+                              migrate_database)
+from state_machine_db.leases import claim_activities, claim_activity, renew_leases
+from state_machine_db.tracing import Tracer
+from state_machine_db.updates import (enqueue_update, fetch_pending_updates,
+                                      acknowledge_updates, activities_with_pending_updates,
+                                      purge_acknowledged_updates)
+from state_machine_db.storage import SCHEMA_VERSION, to_epoch, from_epoch, prepare_database
 
 SQLITE_FILE = 'tests_sm_db.sqlite'
 SQLITE_BASE_PATH = os.path.abspath(SQLITE_FILE)
@@ -13,6 +23,16 @@ if not os.path.isfile(SQLITE_BASE_PATH):
     PATH_SPLIT = SQLITE_BASE_PATH.split('/')
     SQLITE_BASE_PATH = '/'.join(PATH_SPLIT[:-1])+'/tests/'+SQLITE_FILE
 
+
+def copy_fixture_database():
+    """Copies the legacy fixture database to a temporary directory, so the
+    tests migrate and modify the copy instead of the tracked file"""
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, SQLITE_FILE)
+    shutil.copy(SQLITE_BASE_PATH, db_path)
+    return tmp_dir, db_path
+
+
 class MessAroundSM(StateMachine):
     """ Supporting child class of StateMachine """
     def __init__(self, sqlite_bp, activity_id):
@@ -55,20 +75,73 @@ class MessAroundSM(StateMachine):
         return True
 
 
+class TableSM(StateMachine):
+    """ Supporting child class of StateMachine declaring a class-level table """
+    _states_methods = (('read_file', 'read_file'),
+                       ('apply_regex', 'apply_regex'),
+                       ('exit', 'exit'))
+
+    def __init__(self, sqlite_bp, activity_id):
+        super(TableSM, self).__init__(sqlite_bp, activity_id)
+        self.sm_fields = {'activity_creation_date':datetime.now(),
+                          'activity_name': 'table_driven'}
+        self.executed = []
+
+    def get_updated_states(self):
+        return ['read_file', 'apply_regex', 'exit']
+
+    def read_file(self):
+        "read_file state method"
+        self.sm_fields['current_state_creation_date'] = datetime.now()
+        self.executed.append('read_file')
+        return True
+
+    def apply_regex(self):
+        "apply_regex state method"
+        self.sm_fields['current_state_creation_date'] = datetime.now()
+        self.executed.append('apply_regex')
+        return True
+
+    def exit(self):
+        "exit state method"
+        self.sm_fields['current_state_creation_date'] = datetime.now()
+        self.executed.append('exit')
+        return True
+
+
+class QueueSM(TableSM):
+    """ Supporting child class of StateMachine whose states come from queued updates """
+    def __init__(self, sqlite_bp, activity_id, states=None):
+        super(QueueSM, self).__init__(sqlite_bp, activity_id)
+        self.durable_updates = True
+        self.updated_states_list = list(states or [])
+
+    def get_updated_states(self):
+        return self.updated_states_list
+
+    def handle_updates(self, payloads):
+        self.updated_states_list.extend(payloads)
+
+
+class FailingSM(TableSM):
+    """ Supporting child class of StateMachine whose second state fails """
+    def apply_regex(self):
+        "apply_regex state method"
+        return False
+
+
 class StateMachineTest(unittest.TestCase):
     """Unittest tests for all StateMachine's class methods"""
     @classmethod
     def setUpClass(cls):
-        cls.sm = MessAroundSM(SQLITE_BASE_PATH, '001')
+        cls.tmp_dir, cls.db_path = copy_fixture_database()
+        cls.sm = MessAroundSM(cls.db_path, '001')
         cls.sm.start()
         cls.sm.sleep_interval = 0.001
 
     @classmethod
     def tearDownClass(cls):
-        con = sql.connect(SQLITE_BASE_PATH)
-        with con:
-            cur = con.cursor()
-            cur.execute('DELETE FROM "STATE_MACHINE"')
+        shutil.rmtree(cls.tmp_dir)
 
     def test01_check_if_thread_alive(self):
         """Tests check_if_thread_alive method """
@@ -107,5 +180,561 @@ class StateMachineTest(unittest.TestCase):
         self.assertFalse(self.sm.check_if_thread_alive(self.sm.name))
 
 
+class TransitionTableTest(unittest.TestCase):
+    """Unittest tests for the class-level transition table"""
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir, cls.db_path = copy_fixture_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def test01_table_shared_between_instances(self):
+        """Tests that the table is compiled once and shared"""
+        first = TableSM(self.db_path, 'table_001')
+        second = TableSM(self.db_path, 'table_002')
+        self.assertIs(first._transition_table, second._transition_table)
+        self.assertIs(TableSM.__dict__['_transition_table'], first._transition_table)
+        self.assertIsNone(MessAroundSM(self.db_path, 'table_003')._transition_table)
+
+    def test02_table_ids_and_successors(self):
+        """Tests state ids and precomputed successors"""
+        table = TableSM._get_transition_table()
+        self.assertEqual(table.state_ids, {'read_file': 0, 'apply_regex': 1, 'exit': 2})
+        self.assertEqual(table.next_state('read_file'), 'apply_regex')
+        self.assertEqual(table.next_state('apply_regex'), 'exit')
+        self.assertIsNone(table.next_state('exit'))
+
+    def test03_table_validation(self):
+        """Tests that invalid tables are rejected when compiled"""
+        class DuplicatedSM(TableSM):
+            """ Declares the same state twice """
+            _states_methods = (('read_file', 'read_file'), ('read_file', 'exit'))
+
+        class MissingSM(TableSM):
+            """ Declares a state whose method does not exist """
+            _states_methods = (('read_file', 'read_file'), ('unknown', 'unknown'))
+
+        self.assertRaises(ValueError, DuplicatedSM, self.db_path, 'table_004')
+        self.assertRaises(NotImplementedError, MissingSM, self.db_path, 'table_005')
+
+    def test04_run_with_table(self):
+        """Tests that a table driven state machine runs all its states"""
+        machine = TableSM(self.db_path, 'table_006')
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(machine.executed, ['read_file', 'apply_regex', 'exit'])
+        self.assertEqual(machine.current_state, 'exit')
+        self.assertFalse(machine._exec_state('save_file'))
+
+    def test05_skipped_state_is_not_executed(self):
+        """Tests that a declared state left out of the updated states is not executed"""
+        machine = QueueSM(self.db_path, 'table_007', ['read_file', 'exit'])
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(machine.executed, ['read_file', 'exit'])
+
+    def test06_loop_back_to_earlier_state(self):
+        """Tests that an updated state declared before the last executed one is executed"""
+        machine = QueueSM(self.db_path, 'table_008', ['read_file', 'apply_regex'])
+        self.assertTrue(machine._synchronize_states())
+        machine.updated_states_list.extend(['read_file', 'exit'])
+        self.assertTrue(machine._execute_current_actions())
+        self.assertEqual(machine.executed, ['read_file', 'apply_regex', 'read_file', 'exit'])
+        self.assertEqual(machine.current_state, 'exit')
+
+
+class StorageTest(unittest.TestCase):
+    """Unittest tests for the typed STATE_MACHINE layout and its migration"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'legacy.sqlite')
+        con = sql.connect(self.db_path)
+        with con:
+            cur = con.cursor()
+            cur.execute('CREATE TABLE "STATE_MACHINE" ("activity_name" TEXT,'\
+                +'"is_finished" BOOL DEFAULT (null),"current_state" TEXT ,"activity_id" TEXT,'\
+                +'"activity_creation_date" DATETIME,"current_state_creation_date" DATETIME,'\
+                +'"external_id" TEXT)')
+            cur.execute('INSERT INTO STATE_MACHINE VALUES ("legacy", "False", "read_file", '\
+                +'"legacy_001", "2016-02-15 10:00:00", "2016-02-15 10:00:05", "None")')
+            cur.execute('INSERT INTO STATE_MACHINE VALUES ("legacy", "True", "exit", '\
+                +'"legacy_002", "2016-02-15 11:00:00", "2016-02-15 11:00:05", "ext")')
+        con.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test01_epoch_round_trip(self):
+        """Tests conversion between datetimes and epoch timestamps"""
+        date = datetime(2016, 2, 15, 10, 0, 0)
+        self.assertEqual(from_epoch(to_epoch(date)), date)
+        self.assertIsNone(to_epoch(None))
+        self.assertIsNone(from_epoch(None))
+
+    def test02_migrate_legacy_database(self):
+        """Tests that legacy text rows are converted to native types"""
+        self.assertEqual(migrate_database(self.db_path), 2)
+        self.assertEqual(migrate_database(self.db_path), 0)
+        con = sql.connect(self.db_path)
+        cur = con.cursor()
+        cur.execute('PRAGMA user_version')
+        self.assertEqual(cur.fetchone()[0], SCHEMA_VERSION)
+        cur.execute('SELECT is_finished, activity_creation_date, external_id FROM '\
+            +'STATE_MACHINE ORDER BY activity_id')
+        rows = cur.fetchall()
+        con.close()
+        self.assertEqual(rows[0], (0, to_epoch(datetime(2016, 2, 15, 10, 0, 0)), None))
+        self.assertEqual(rows[1], (1, to_epoch(datetime(2016, 2, 15, 11, 0, 0)), 'ext'))
+
+    def test03_resume_migrated_activity(self):
+        """Tests that an activity stored in the legacy layout is resumed"""
+        machine = TableSM(self.db_path, 'legacy_001')
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(machine.executed, ['apply_regex', 'exit'])
+        finished = TableSM(self.db_path, 'legacy_002')
+        self.assertTrue(finished._synchronize_states())
+        self.assertTrue(finished.is_finished)
+        self.assertEqual(finished.executed, [])
+
+    def test04_migrate_bad_legacy_rows(self):
+        """Tests that rows without id are skipped and duplicated ids keep their last row"""
+        con = sql.connect(self.db_path)
+        with con:
+            cur = con.cursor()
+            cur.execute('INSERT INTO STATE_MACHINE VALUES ("legacy", "False", "read_file", '\
+                +'NULL, "2016-02-15 12:00:00", "2016-02-15 12:00:05", "None")')
+            cur.execute('INSERT INTO STATE_MACHINE VALUES ("legacy", "True", "exit", '\
+                +'"legacy_001", "2016-02-15 10:00:00", "2016-02-15 10:00:09", "None")')
+        con.close()
+        self.assertEqual(migrate_database(self.db_path), 2)
+        con = sql.connect(self.db_path)
+        cur = con.cursor()
+        cur.execute('SELECT is_finished, current_state FROM STATE_MACHINE '\
+            +'WHERE activity_id = "legacy_001"')
+        self.assertEqual(cur.fetchall(), [(1, 'exit')])
+        con.close()
+
+    def test05_prepare_recreated_database(self):
+        """Tests that a database reached by another path or recreated is prepared"""
+        prepare_database(self.db_path)
+        relative_path = os.path.relpath(self.db_path)
+        prepare_database(relative_path)
+        os.remove(self.db_path)
+        sql.connect(self.db_path).close()
+        prepare_database(relative_path)
+        machine = TableSM(self.db_path, 'recreated_001')
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(machine.current_state, 'exit')
+
+
+class LeaseTest(unittest.TestCase):
+    """Unittest tests for lease based ownership of activities"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'leases.sqlite')
+        migrate_database(self.db_path)
+        con = sql.connect(self.db_path)
+        with con:
+            con.executemany('INSERT INTO STATE_MACHINE (activity_id, is_finished, '\
+                +'activity_creation_date) VALUES (?, ?, ?)',
+                            [('lease_001', 0, 1), ('lease_002', 0, 2),
+                             ('lease_003', 0, 3), ('lease_004', 1, 4)])
+        con.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test01_claim_batches(self):
+        """Tests that workers claim disjoint batches of unfinished activities"""
+        first = claim_activities(self.db_path, 'worker_a', 2, 30, now=100)
+        second = claim_activities(self.db_path, 'worker_b', 2, 30, now=100)
+        self.assertEqual(first, ['lease_001', 'lease_002'])
+        self.assertEqual(second, ['lease_003'])
+        self.assertEqual(claim_activities(self.db_path, 'worker_b', 2, 30, now=100), [])
+
+    def test02_expired_leases_are_claimed(self):
+        """Tests that activities of a dead worker are claimed again"""
+        claim_activities(self.db_path, 'worker_a', 3, 30, now=100)
+        self.assertEqual(renew_leases(self.db_path, 'worker_a', ['lease_001'], 30, now=120),
+                         ['lease_001'])
+        claimed = claim_activities(self.db_path, 'worker_b', 3, 30, now=140)
+        self.assertEqual(claimed, ['lease_002', 'lease_003'])
+        self.assertEqual(renew_leases(self.db_path, 'worker_a', ['lease_002'], 30, now=141), [])
+
+    def test03_claim_single_activity(self):
+        """Tests claiming one activity, including one without an entry"""
+        self.assertTrue(claim_activity(self.db_path, 'lease_005', 'worker_a', 30, now=100))
+        self.assertTrue(claim_activity(self.db_path, 'lease_005', 'worker_a', 30, now=110))
+        self.assertFalse(claim_activity(self.db_path, 'lease_005', 'worker_b', 30, now=120))
+        self.assertTrue(claim_activity(self.db_path, 'lease_005', 'worker_b', 30, now=150))
+
+    def test04_lost_lease_stops_machine(self):
+        """Tests that a state machine stops saving once its lease is taken over"""
+        machine = TableSM(self.db_path, 'lease_006')
+        machine.lease_owner = 'worker_a'
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(machine.current_state, 'exit')
+        intruder = TableSM(self.db_path, 'lease_006')
+        intruder.lease_owner = 'worker_b'
+        self.assertFalse(intruder._synchronize_states())
+        con = sql.connect(self.db_path)
+        with con:
+            con.execute('UPDATE STATE_MACHINE SET lease_owner = "worker_b" '\
+                +'WHERE activity_id = "lease_006"')
+        con.close()
+        self.assertFalse(machine._exec_state('read_file'))
+
+    def test05_worker_resumes_activities(self):
+        """Tests that a worker resumes the activities it claims"""
+        worker = StateMachineWorker(self.db_path, TableSM, owner='worker_a',
+                                    batch_size=2, max_machines=2, lease_duration=30)
+        self.assertEqual(worker.claim(), ['lease_001', 'lease_002'])
+        self.assertEqual(worker.claim(), [])
+        sleep(0.15)
+        for machine in worker.machines.values():
+            self.assertEqual(machine.executed, ['read_file', 'apply_regex', 'exit'])
+            self.assertEqual(machine.lease_owner, 'worker_a')
+        worker.heartbeat()
+        self.assertEqual(sorted(worker.machines), ['lease_001', 'lease_002'])
+
+    def test06_failed_activity_keeps_lease(self):
+        """Tests that a failed activity is not claimed again before its lease expires"""
+        worker = StateMachineWorker(self.db_path, FailingSM, owner='worker_a',
+                                    batch_size=3, lease_duration=30)
+        self.assertEqual(worker.claim(), ['lease_001', 'lease_002', 'lease_003'])
+        sleep(0.15)
+        worker.heartbeat()
+        self.assertEqual(worker.machines, {})
+        self.assertEqual(worker.claim(), [])
+        self.assertEqual(claim_activities(self.db_path, 'worker_b', 3, 30,
+                                          now=int(time())+60),
+                         ['lease_001', 'lease_002', 'lease_003'])
+
+    def test07_run_renews_lease(self):
+        """Tests that an idle running machine renews its lease and stops once it loses it"""
+        machine = TableSM(self.db_path, 'lease_007')
+        machine.lease_owner = 'worker_a'
+        machine.sleep_interval = 0.001
+        machine.start()
+        sleep(0.1)
+        self.assertTrue(machine.is_alive())
+        machine._lease_renewed_at = 0
+        sleep(0.1)
+        self.assertTrue(machine._lease_renewed_at > 0)
+        con = sql.connect(self.db_path)
+        with con:
+            con.execute('UPDATE STATE_MACHINE SET lease_owner = "worker_b" '\
+                +'WHERE activity_id = "lease_007"')
+        con.close()
+        machine._lease_renewed_at = 0
+        machine.join(1)
+        self.assertFalse(machine.is_alive())
+
+    def test08_finished_activity_is_not_claimed_again(self):
+        """Tests that an activity finished by its machine is not claimed again"""
+        def sm_factory(sm_database_path, activity_id):
+            machine = TableSM(sm_database_path, activity_id)
+            machine.sleep_interval = 0.001
+            return machine
+        worker = StateMachineWorker(self.db_path, sm_factory, owner='worker_a',
+                                    batch_size=1, lease_duration=30)
+        self.assertEqual(worker.claim(), ['lease_001'])
+        machine = worker.machines['lease_001']
+        sleep(0.1)
+        machine.is_finished = True
+        machine.join(1)
+        worker.heartbeat()
+        self.assertEqual(worker.machines, {})
+        self.assertEqual(claim_activities(self.db_path, 'worker_b', 3, 30,
+                                          now=int(time())+60),
+                         ['lease_002', 'lease_003'])
+
+    def test09_stopped_worker_stops_its_machines(self):
+        """Tests that a stopped worker stops its machines before releasing their leases"""
+        def sm_factory(sm_database_path, activity_id):
+            machine = TableSM(sm_database_path, activity_id)
+            machine.sleep_interval = 0.001
+            return machine
+        worker = StateMachineWorker(self.db_path, sm_factory, owner='worker_a',
+                                    batch_size=3, lease_duration=30)
+        worker.start()
+        sleep(0.1)
+        machines = list(worker.machines.values())
+        self.assertEqual(len(machines), 3)
+        worker.stop()
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+        for machine in machines:
+            self.assertFalse(machine.is_alive())
+            self.assertFalse(machine.is_finished)
+        self.assertEqual(claim_activities(self.db_path, 'worker_b', 3, 30),
+                         ['lease_001', 'lease_002', 'lease_003'])
+
+
+class UpdatesTest(unittest.TestCase):
+    """Unittest tests for the durable queue of inbound updates"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'updates.sqlite')
+        migrate_database(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test01_queue_and_acknowledge(self):
+        """Tests that acknowledged updates are no longer pending"""
+        first = enqueue_update(self.db_path, 'queue_001', 'read_file')
+        second = enqueue_update(self.db_path, 'queue_001', 'apply_regex')
+        self.assertEqual(fetch_pending_updates(self.db_path, 'queue_001', 1),
+                         [(first, 'read_file')])
+        self.assertEqual(activities_with_pending_updates(self.db_path, 10), ['queue_001'])
+        QueueSM(self.db_path, 'queue_001', ['read_file'])._save_state_to_db('read_file')
+        self.assertTrue(acknowledge_updates(self.db_path, 'queue_001', first))
+        self.assertEqual(fetch_pending_updates(self.db_path, 'queue_001', 10),
+                         [(second, 'apply_regex')])
+        self.assertEqual(purge_acknowledged_updates(self.db_path), 1)
+
+    def test02_updates_acknowledged_with_state(self):
+        """Tests that handled updates are acknowledged when the state is saved"""
+        machine = QueueSM(self.db_path, 'queue_002')
+        machine.post_update('read_file')
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(machine.executed, ['read_file'])
+        enqueue_update(self.db_path, 'queue_002', 'apply_regex')
+        self.assertTrue(machine._drain_updates())
+        self.assertTrue(machine._execute_current_actions())
+        self.assertEqual(machine.executed, ['read_file', 'apply_regex'])
+        self.assertEqual(fetch_pending_updates(self.db_path, 'queue_002', 10), [])
+        self.assertFalse(machine._drain_updates())
+
+    def test03_restart_replays_unacknowledged_updates(self):
+        """Tests that a restarted machine only replays the pending updates"""
+        machine = QueueSM(self.db_path, 'queue_003', ['read_file'])
+        enqueue_update(self.db_path, 'queue_003', 'apply_regex')
+        self.assertTrue(machine._synchronize_states())
+        enqueue_update(self.db_path, 'queue_003', 'exit')
+        self.assertEqual(activities_with_pending_updates(self.db_path, 10), ['queue_003'])
+        restarted = QueueSM(self.db_path, 'queue_003', ['read_file', 'apply_regex'])
+        self.assertTrue(restarted._synchronize_states())
+        self.assertEqual(restarted.executed, ['exit'])
+        self.assertEqual(activities_with_pending_updates(self.db_path, 10), [])
+
+    def test04_post_update_to_unprepared_database(self):
+        """Tests that updates can be posted before the database is prepared"""
+        db_path = os.path.join(self.tmp_dir, 'unprepared.sqlite')
+        machine = QueueSM(db_path, 'queue_004')
+        update_id = machine.post_update('read_file')
+        self.assertEqual(fetch_pending_updates(db_path, 'queue_004', 10),
+                         [(update_id, 'read_file')])
+        self.assertEqual(activities_with_pending_updates(db_path, 10), ['queue_004'])
+        _, legacy_path = copy_fixture_database()
+        self.assertTrue(enqueue_update(legacy_path, 'queue_005', 'read_file'))
+        shutil.rmtree(os.path.dirname(legacy_path))
+
+    def test05_failed_acknowledgement_keeps_updates_pending(self):
+        """Tests that updates whose acknowledgement failed are not handed out twice"""
+        machine = QueueSM(self.db_path, 'queue_006')
+        machine.post_update('read_file')
+        self.assertTrue(machine._drain_updates())
+        self.assertTrue(machine._acknowledge_pending_updates())
+        self.assertIsNotNone(machine._pending_update_id)
+        self.assertFalse(machine._drain_updates())
+        self.assertEqual(machine.updated_states_list, ['read_file'])
+        self.assertTrue(machine._synchronize_states())
+        self.assertEqual(fetch_pending_updates(self.db_path, 'queue_006', 10), [])
+
+    def test06_lost_lease_stops_acknowledgement(self):
+        """Tests that a machine stops when its updates cannot be acknowledged"""
+        machine = QueueSM(self.db_path, 'queue_007', ['read_file', 'apply_regex', 'exit'])
+        machine.lease_owner = 'worker_a'
+        self.assertTrue(machine._synchronize_states())
+        con = sql.connect(self.db_path)
+        with con:
+            con.execute('UPDATE STATE_MACHINE SET lease_owner = "worker_b" '\
+                +'WHERE activity_id = "queue_007"')
+        con.close()
+        enqueue_update(self.db_path, 'queue_007', 'exit')
+        self.assertTrue(machine._drain_updates())
+        self.assertFalse(machine._execute_current_actions())
+        self.assertIsNotNone(machine._pending_update_id)
+
+    def test07_post_update_without_durable_updates(self):
+        """Tests that updates are only flagged when durable_updates is off"""
+        machine = QueueSM(self.db_path, 'queue_008')
+        machine.durable_updates = False
+        self.assertIsNone(machine.post_update('read_file'))
+        self.assertTrue(machine.update_flag)
+        self.assertEqual(fetch_pending_updates(self.db_path, 'queue_008', 10), [])
+
+    def test08_failed_handle_updates_stops_machine(self):
+        """Tests that an error while handling updates stops the machine and keeps them pending"""
+        machine = QueueSM(self.db_path, 'queue_009')
+        machine.handle_updates = lambda payloads: 1/0
+        update_id = machine.post_update('read_file')
+        self.assertIsNone(machine._drain_updates())
+        self.assertFalse(machine._synchronize_states())
+        self.assertIsNone(machine._pending_update_id)
+        self.assertEqual(fetch_pending_updates(self.db_path, 'queue_009', 10),
+                         [(update_id, 'read_file')])
+
+
+class TracingTest(unittest.TestCase):
+    """Unittest tests for the tracer and its state machine hooks"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'tracing.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test01_tail_sampling(self):
+        """Tests that only transitions above the threshold are kept"""
+        tracer = Tracer(threshold=0.01)
+        with tracer.transition('fast'):
+            with tracer.span('step'):
+                pass
+        with tracer.transition('slow'):
+            with tracer.span('step'):
+                sleep(0.02)
+        self.assertEqual([span['name'] for span in tracer.spans()], ['step', 'slow'])
+
+    def test02_sampling_off_and_ring_buffer(self):
+        """Tests that unsampled transitions record nothing and memory is bounded"""
+        tracer = Tracer(sample_rate=0)
+        with tracer.transition('unsampled'):
+            with tracer.span('step'):
+                pass
+        with tracer.span('standalone'):
+            pass
+        self.assertEqual(tracer.spans(), [])
+        tracer = Tracer(max_spans=3)
+        for index in range(5):
+            with tracer.span('step', index=index):
+                pass
+        self.assertEqual([span['args']['index'] for span in tracer.spans()], [2, 3, 4])
+
+    def test03_state_machine_spans(self):
+        """Tests that state methods and persistence calls are traced"""
+        tracer = Tracer()
+        machine = TableSM(self.db_path, 'trace_001')
+        machine.tracer = tracer
+        with machine._transition('synchronize_states'):
+            self.assertTrue(machine._synchronize_states())
+        names = [span['name'] for span in tracer.spans()]
+        self.assertEqual(names, ['get_updated_states', 'restore_state',
+                                 'exec_state', 'save_state', 'exec_state', 'save_state',
+                                 'exec_state', 'save_state', 'synchronize_states'])
+        self.assertEqual(tracer.spans()[2]['args'],
+                         {'activity_id': 'trace_001', 'state': 'read_file'})
+        events = json.loads(tracer.dump_chrome_trace())['traceEvents']
+        self.assertEqual(len(events), len(names))
+        self.assertEqual(events[-1]['ph'], 'X')
+        self.assertEqual(len(json.loads(tracer.dump_json())), len(names))
+
+    def test04_queued_updates_traced_in_transition(self):
+        """Tests that handling queued updates counts toward the transition, and idle polls do not"""
+        tracer = Tracer()
+        machine = QueueSM(self.db_path, 'trace_002', ['read_file'])
+        machine.sleep_interval = 0.001
+        machine.tracer = tracer
+        machine.start()
+        sleep(0.1)
+        tracer.clear()
+        sleep(0.05)
+        self.assertEqual(tracer.spans(), [])
+        machine.post_update('exit')
+        sleep(0.1)
+        machine.stop()
+        machine.join(1)
+        names = [span['name'] for span in tracer.spans()]
+        self.assertEqual(names, ['fetch_pending_updates', 'handle_updates', 'get_updated_states',
+                                 'exec_state', 'save_state', 'execute_current_actions'])
+
+
+class ActivityCacheTest(unittest.TestCase):
+    """Unittest tests for the activity records cache"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test01_lru_eviction_and_hooks(self):
+        """Tests that the least recently used records are evicted and hooks notified"""
+        cache = ActivityCache(max_size=2)
+        invalidated = []
+        cache.add_invalidation_hook(lambda path, activity_id: invalidated.append(activity_id))
+        cache.put('db', 'a', {'current_state': 'read_file'})
+        cache.put('db', 'b', {'current_state': 'read_file'})
+        self.assertEqual(cache.get('db', 'a'), {'current_state': 'read_file'})
+        cache.put('db', 'c', {'current_state': 'read_file'})
+        self.assertIsNone(cache.get('db', 'b'))
+        self.assertEqual(len(cache), 2)
+        cache.invalidate('db', 'a')
+        cache.invalidate('db')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(invalidated, ['a', None])
+
+    def test02_read_through_write_through(self):
+        """Tests that saved states are restored from the cache until invalidated"""
+        cache = ActivityCache()
+        machine = TableSM(self.db_path, 'cache_001')
+        machine.activity_cache = cache
+        self.assertTrue(machine._synchronize_states())
+        misses = cache.misses
+        restarted = TableSM(self.db_path, 'cache_001')
+        restarted.activity_cache = cache
+        self.assertEqual(restarted._restore_state_from_db(), 'exit')
+        self.assertEqual(cache.misses, misses)
+        con = sql.connect(self.db_path)
+        with con:
+            con.execute('UPDATE STATE_MACHINE SET current_state = "apply_regex"')
+        con.close()
+        self.assertEqual(restarted._restore_state_from_db(), 'exit')
+        cache.invalidate(self.db_path, 'cache_001')
+        self.assertEqual(restarted._restore_state_from_db(), 'apply_regex')
+
+    def test03_row_changed_outside_the_process(self):
+        """Tests that saving and restoring follow rows deleted by another process"""
+        cache = ActivityCache()
+        machine = TableSM(self.db_path, 'cache_002')
+        cached = TableSM(self.db_path, 'cache_003')
+        cached.activity_cache = cache
+        self.assertTrue(machine._synchronize_states())
+        self.assertTrue(cached._synchronize_states())
+        con = sql.connect(self.db_path)
+        with con:
+            con.execute('DELETE FROM STATE_MACHINE')
+        con.close()
+        self.assertIsNone(TableSM(self.db_path, 'cache_002')._restore_state_from_db())
+        self.assertTrue(machine._exec_state('exit'))
+        self.assertTrue(cached._exec_state('exit'))
+        con = sql.connect(self.db_path)
+        cur = con.cursor()
+        cur.execute('SELECT activity_id, current_state, activity_name FROM STATE_MACHINE '\
+            +'ORDER BY activity_id')
+        self.assertEqual(cur.fetchall(), [('cache_002', 'exit', 'table_driven'),
+                                          ('cache_003', 'exit', 'table_driven')])
+        con.close()
+
+    def test04_paths_to_the_same_database(self):
+        """Tests that records are shared and invalidated across paths to the same database"""
+        cache = ActivityCache()
+        invalidated = []
+        cache.add_invalidation_hook(lambda path, activity_id: invalidated.append(path))
+        relative_path = os.path.relpath(self.db_path)
+        link_path = os.path.join(self.tmp_dir, 'link.sqlite')
+        os.symlink(self.db_path, link_path)
+        cache.put(relative_path, 'cache_004', {'current_state': 'read_file'})
+        self.assertEqual(cache.get(link_path, 'cache_004'), {'current_state': 'read_file'})
+        cache.invalidate(self.db_path, 'cache_004')
+        self.assertIsNone(cache.get(relative_path, 'cache_004'))
+        cache.put(link_path, 'cache_005', {'current_state': 'read_file'})
+        cache.invalidate(relative_path)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(invalidated, [os.path.realpath(self.db_path)]*2)
+
+
 if __name__ == "__main__":
     unittest.main()